@@ -4,43 +4,81 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
 import uuid
-from datetime import datetime
+import bisect
+import threading
+from datetime import datetime, date
 
 # --- DATABASE SETUP ---
+@st.cache_resource
+def get_write_lock():
+    """Returns the lock that serializes writes on the shared connection across Streamlit sessions."""
+    # Cached like the connection, since Streamlit re-executes this module on every rerun
+    return threading.Lock()
+
+@st.cache_resource
+def get_conn():
+    """Returns a single SQLite connection shared by every session of the app."""
+    conn = sqlite3.connect('medirepo.db', check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=normal")
+    conn.execute("PRAGMA temp_store=memory")
+    conn.execute("PRAGMA cache_size=-64000")
+    return conn
+
+# Login columns are COLLATE NOCASE so case-insensitive lookups can use indexes
+PATIENTS_COLUMNS = '''
+    unique_id TEXT PRIMARY KEY COLLATE NOCASE,
+    first_name TEXT NOT NULL COLLATE NOCASE,
+    last_name TEXT,
+    email TEXT UNIQUE NOT NULL,
+    phone TEXT UNIQUE NOT NULL,
+    dob TEXT,
+    location TEXT,
+    height_cm REAL,
+    diet_pref TEXT,
+    gender TEXT
+'''
+
+DOCTORS_COLUMNS = '''
+    doctor_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    first_name TEXT NOT NULL COLLATE NOCASE,
+    last_name TEXT NOT NULL COLLATE NOCASE,
+    email TEXT UNIQUE NOT NULL,
+    phone TEXT UNIQUE NOT NULL,
+    speciality TEXT NOT NULL
+'''
+
+def migrate_to_nocase(c, table, columns):
+    """Rebuilds a table created before its login columns were declared COLLATE NOCASE."""
+    schema = c.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+    if 'COLLATE NOCASE' in schema:
+        return
+    with get_write_lock():
+        c.execute("BEGIN")
+        try:
+            c.execute(f"CREATE TABLE {table}_new ({columns})")
+            c.execute(f"INSERT INTO {table}_new SELECT * FROM {table}")
+            c.execute(f"DROP TABLE {table}")
+            c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+@st.cache_resource
 def init_db():
-    """Initializes the SQLite database and creates tables if they don't exist."""
-    conn = sqlite3.connect('medirepo.db')
-    c = conn.cursor()
+    """Initializes the SQLite database and creates tables if they don't exist. Runs once per server process."""
+    c = get_conn().cursor()
     
     # Patients Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            unique_id TEXT PRIMARY KEY,
-            first_name TEXT NOT NULL,
-            last_name TEXT,
-            email TEXT UNIQUE NOT NULL,
-            phone TEXT UNIQUE NOT NULL,
-            dob TEXT,
-            location TEXT,
-            height_cm REAL,
-            diet_pref TEXT,
-            gender TEXT
-        )
-    ''')
+    c.execute(f"CREATE TABLE IF NOT EXISTS patients ({PATIENTS_COLUMNS})")
     
     # Doctors Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS doctors (
-            doctor_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            first_name TEXT NOT NULL,
-            last_name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            phone TEXT UNIQUE NOT NULL,
-            speciality TEXT NOT NULL
-        )
-    ''')
+    c.execute(f"CREATE TABLE IF NOT EXISTS doctors ({DOCTORS_COLUMNS})")
 
     # Vitals Table
     c.execute('''
@@ -72,46 +110,287 @@ def init_db():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+    # Older databases were created without case-insensitive name/ID columns
+    migrate_to_nocase(c, 'patients', PATIENTS_COLUMNS)
+    migrate_to_nocase(c, 'doctors', DOCTORS_COLUMNS)
+
+    # Indexes for the per-patient lookups and the login query
+    c.execute("CREATE INDEX IF NOT EXISTS idx_vitals_pid_date ON vitals(patient_id, record_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rx_pid_date ON prescriptions(patient_id, visit_date DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_patients_login ON patients(first_name COLLATE NOCASE, unique_id)")
+
+    # Enabled after the migration above, which drops and recreates referenced tables
+    c.execute("PRAGMA foreign_keys=ON")
+    return True
+
+# --- SQL STATEMENTS ---
+# Kept as module-level constants so the connection's statement cache reuses the compiled queries
+SQL_VITALS = """SELECT record_date AS "Date", weight_kg AS "Weight (kg)", bp_systolic AS "BP Systolic", bp_diastolic AS "BP Diastolic",
+                       heart_rate AS "Heart Rate (BPM)", sugar_level AS "Sugar Level"
+                FROM vitals WHERE patient_id = ? ORDER BY record_date ASC"""
+SQL_RX = """SELECT visit_date AS "Visit Date", doctor_name AS "Doctor", summary AS "Summary", medicine AS "Medicine",
+                   frequency AS "Frequency", timing AS "Timing"
+            FROM prescriptions WHERE patient_id = ? ORDER BY visit_date DESC"""
+SQL_LATEST_WEIGHT = "SELECT weight_kg FROM vitals WHERE patient_id = ? AND weight_kg IS NOT NULL ORDER BY record_date DESC, vital_id DESC LIMIT 1"
+SQL_INSERT_VITALS = "INSERT INTO vitals (patient_id, record_date, weight_kg, bp_systolic, bp_diastolic, heart_rate, sugar_level) VALUES (?,?,?,?,?,?,?)"
+SQL_UPDATE_PROFILE = "UPDATE patients SET height_cm=?, dob=?, gender=?, diet_pref=?, location=? WHERE unique_id=?"
+SQL_INSERT_PATIENT = "INSERT INTO patients (unique_id, first_name, last_name, email, phone) VALUES (?,?,?,?,?)"
+SQL_LOGIN_PATIENT = "SELECT unique_id, first_name, last_name, email, phone, dob, location, height_cm, diet_pref, gender FROM patients WHERE first_name=? AND unique_id=?"
+# {values} expands to one (:nameN, :freqN, :timingN) tuple per medicine
+SQL_INSERT_RX = """INSERT INTO prescriptions (patient_id, doctor_name, visit_date, summary, medicine, frequency, timing)
+                   WITH m(name, freq, timing) AS (VALUES {values})
+                   SELECT :pid, :doc, :date, :sum, m.name, m.freq, m.timing FROM m
+                   WHERE EXISTS (SELECT 1 FROM patients WHERE unique_id = :pid)"""
+SQL_INSERT_DOCTOR = "INSERT INTO doctors (first_name, last_name, email, phone, speciality) VALUES (?,?,?,?,?)"
+SQL_LOGIN_DOCTOR = "SELECT doctor_id AS id, first_name, last_name, email, phone, speciality FROM doctors WHERE first_name=? AND last_name=? AND phone=?"
 
 # --- HELPER FUNCTIONS (DATABASE INTERACTIONS) ---
 def db_execute(query, params=()):
-    """A helper function to execute database queries."""
-    conn = sqlite3.connect('medirepo.db')
-    c = conn.cursor()
-    c.execute(query, params)
-    conn.commit()
-    conn.close()
+    """A helper function to execute database queries. Returns the number of rows changed."""
+    with get_write_lock():
+        return get_conn().execute(query, params).rowcount
 
 def db_query(query, params=()):
     """A helper function to fetch data from the database."""
-    conn = sqlite3.connect('medirepo.db')
-    c = conn.cursor()
-    c.execute(query, params)
-    data = c.fetchall()
-    conn.close()
-    return data
+    return get_conn().execute(query, params).fetchall()
 
 # --- PATIENT SPECIFIC FUNCTIONS ---
+# Vitals and prescriptions are cached separately rather than fetched together, so a vitals save
+# only invalidates the vitals entry and the saving session can skip re-reading its history
+@st.cache_data(ttl=60, show_spinner=False)
 def get_patient_vitals(patient_id):
     """Fetches all vitals for a given patient and returns a DataFrame."""
-    vitals_data = db_query("SELECT record_date, weight_kg, bp_systolic, bp_diastolic, heart_rate, sugar_level FROM vitals WHERE patient_id = ? ORDER BY record_date ASC", (patient_id,))
-    if not vitals_data:
-        return pd.DataFrame()
-    df = pd.DataFrame(vitals_data, columns=['Date', 'Weight (kg)', 'BP Systolic', 'BP Diastolic', 'Heart Rate (BPM)', 'Sugar Level'])
-    df['Date'] = pd.to_datetime(df['Date'])
-    return df
+    return pd.read_sql_query(SQL_VITALS, get_conn(), params=(patient_id,), parse_dates=['Date'])
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_patient_prescriptions(patient_id):
     """Fetches all prescriptions for a patient."""
-    rx_data = db_query("SELECT visit_date, doctor_name, summary, medicine, frequency, timing FROM prescriptions WHERE patient_id = ? ORDER BY visit_date DESC", (patient_id,))
-    if not rx_data:
-        return pd.DataFrame()
-    df = pd.DataFrame(rx_data, columns=['Visit Date', 'Doctor', 'Summary', 'Medicine', 'Frequency', 'Timing'])
-    return df
+    return pd.read_sql_query(SQL_RX, get_conn(), params=(patient_id,))
+
+@st.cache_resource
+def get_vitals_versions():
+    """Returns the process-wide map of patient_id -> number of vitals saves, shared by all sessions."""
+    return {}
+
+def bump_vitals_version(patient_id):
+    """Marks a patient's vitals as changed for every session and returns the (old, new) versions."""
+    versions = get_vitals_versions()
+    with get_write_lock():
+        old_version = versions.get(patient_id, 0)
+        versions[patient_id] = old_version + 1
+    return old_version, old_version + 1
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_latest_weight(patient_id):
+    """Fetches the most recent recorded weight for a patient, or None."""
+    row = db_query(SQL_LATEST_WEIGHT, (patient_id,))
+    return row[0]['weight_kg'] if row else None
+
+# --- CHART FUNCTIONS ---
+def hash_vitals_df(df):
+    """Hashes a vitals DataFrame by content so cached figures track data changes."""
+    return pd.util.hash_pandas_object(df, index=True).values.tobytes()
+
+# Upper bound on points per chart trace sent to the browser
+MAX_CHART_POINTS = 1000
+
+def lttb_indices(x, y, threshold):
+    """Returns the positions kept by Largest-Triangle-Three-Buckets downsampling."""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    bucket_size = (n - 2) / (threshold - 2)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        # Keep the point forming the largest triangle with the last kept point and the next bucket's average
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        kept[i + 1] = a
+    return kept
+
+def downsample_vitals(vitals_df, col, threshold=MAX_CHART_POINTS):
+    """Returns the Date and `col` rows to chart for one column, at most `threshold` of them."""
+    # Rows without a reading are always skipped, so a chart looks the same at any history length
+    series = vitals_df[['Date', col]].dropna()
+    if len(series) <= threshold:
+        return series
+    x = series['Date'].to_numpy().astype('int64').astype(float)
+    y = series[col].to_numpy(dtype=float)
+    return series.iloc[lttb_indices(x, y, threshold)]
+
+# Bounds the figure cache: four charts each for ~50 concurrently active patients
+FIG_CACHE_ENTRIES = 4 * 50
+
+@st.cache_data(ttl=60, max_entries=FIG_CACHE_ENTRIES, show_spinner=False, hash_funcs={pd.DataFrame: hash_vitals_df})
+def build_trend_fig(vitals_df, y, title):
+    """Builds a line chart of one or more vitals columns over time."""
+    columns = [y] if isinstance(y, str) else y
+    traces = []
+    for col in columns:
+        plot_df = downsample_vitals(vitals_df, col)
+        traces.append(go.Scattergl(x=plot_df['Date'], y=plot_df[col], mode='lines+markers', name=col))
+    return go.Figure(traces, layout=dict(title=title, xaxis_title='Date', yaxis_title=columns[0] if len(columns) == 1 else None,
+                                         showlegend=len(columns) > 1))
 
 # --- UI & LOGIC FUNCTIONS ---
+def add_derived_profile_fields(user_info):
+    """Stores age and height in metres on user_info so the dashboard doesn't recompute them."""
+    dob = user_info.get('dob')
+    height_cm = user_info.get('height_cm')
+    user_info['age'] = datetime.now().year - date.fromisoformat(dob).year if dob else None
+    user_info['height_m'] = height_cm / 100 if height_cm else None
+    return user_info
+
+# BMI category boundaries; a BMI equal to a boundary falls in the higher category
+BMI_THRESHOLDS = (18.5, 25.0, 30.0)
+BMI_CATEGORIES = ("Underweight", "Healthy Weight", "Overweight", "Obesity")
+
+# Selectbox options, with value -> index lookups for preselecting saved values
+GENDER_OPTIONS = ["Male", "Female", "Other", "Prefer not to say"]
+DIET_OPTIONS = ["Vegetarian", "Non-Vegetarian", "Ovo-Vegetarian", "Jain"]
+FREQUENCY_OPTIONS = ["Once a day", "Twice a day", "Thrice a day"]
+TIMING_OPTIONS = ["Empty Stomach", "After Breakfast", "After Lunch", "After Dinner", "Before Sleep"]
+GENDER_IDX = {g: i for i, g in enumerate(GENDER_OPTIONS)}
+DIET_IDX = {d: i for i, d in enumerate(DIET_OPTIONS)}
+FREQUENCY_IDX = {f: i for i, f in enumerate(FREQUENCY_OPTIONS)}
+TIMING_IDX = {t: i for i, t in enumerate(TIMING_OPTIONS)}
+
+@st.fragment
+def render_vitals_tab(vitals_df):
+    """Renders the vitals charts tab."""
+    st.subheader("Your Health Journey Over Time")
+    if vitals_df.empty:
+        st.info("No vitals data found. Add some data to see your charts!")
+    else:
+        # Weight Chart
+        if 'Weight (kg)' in vitals_df.columns and vitals_df['Weight (kg)'].notna().any():
+            fig_weight = build_trend_fig(vitals_df, 'Weight (kg)', 'Weight Journey')
+            st.plotly_chart(fig_weight, use_container_width=True)
+    
+        # BP Chart
+        if 'BP Systolic' in vitals_df.columns and vitals_df['BP Systolic'].notna().any():
+            fig_bp = build_trend_fig(vitals_df, ['BP Systolic', 'BP Diastolic'], 'Blood Pressure Trends')
+            st.plotly_chart(fig_bp, use_container_width=True)
+    
+        # Heart Rate Chart
+        if 'Heart Rate (BPM)' in vitals_df.columns and vitals_df['Heart Rate (BPM)'].notna().any():
+            fig_hr = build_trend_fig(vitals_df, 'Heart Rate (BPM)', 'Heart Rate Trends')
+            st.plotly_chart(fig_hr, use_container_width=True)
+
+        # Sugar Chart
+        if 'Sugar Level' in vitals_df.columns and vitals_df['Sugar Level'].notna().any():
+            fig_sugar = build_trend_fig(vitals_df, 'Sugar Level', 'Blood Sugar Trends')
+            st.plotly_chart(fig_sugar, use_container_width=True)
+
+@st.fragment
+def render_rx_tab(rx_df):
+    """Renders the prescription history tab."""
+    st.subheader("Your Prescription History")
+    if rx_df.empty:
+        st.info("No prescriptions recorded.")
+    else:
+        # Group by visit to show a clean record
+        for visit_date, group in rx_df.groupby('Visit Date'):
+            with st.expander(f"**Visit on {visit_date.split(' ')[0]}** with {group['Doctor'].iloc[0]}"):
+                st.write(f"**Diagnosis:** {group['Summary'].iloc[0] or 'N/A'}")
+                st.dataframe(group[['Medicine', 'Frequency', 'Timing']].reset_index(drop=True), use_container_width=True)
+
+@st.fragment
+def render_fitness_tab(user):
+    """Renders the BMI metric and fitness plan tab."""
+    st.subheader("Your Fitness & Wellness Hub")
+    latest_weight = get_latest_weight(user['unique_id'])
+    if user.get('height_cm') and user.get('height_cm') > 0 and latest_weight is not None:
+        bmi = latest_weight / (user['height_m'] ** 2)
+        bmi_category = BMI_CATEGORIES[bisect.bisect_right(BMI_THRESHOLDS, bmi)]
+
+        st.metric(label="Your Current BMI", value=f"{bmi:.2f}", help=f"Your current BMI category is {bmi_category}. Formula: $BMI = \\frac{{\\text{{weight (kg)}}}}{{\\text{{height (m)}}^2}}$")
+    else:
+        st.warning("Please add your height in the profile and at least one weight entry to calculate BMI.")
+
+    st.divider()
+    # *** UPDATED BUTTON TEXT ***
+    if st.button("Create My Fitness Plan"):
+        st.session_state.show_fitness_form = True
+
+    if st.session_state.get("show_fitness_form"):
+        with st.form("fitness_form"):
+            goal_weight = st.number_input("What is your goal weight (kg)?", min_value=30.0, step=1.0)
+        
+            submitted = st.form_submit_button("Calculate My Plan")
+            if submitted and goal_weight > 0 and user.get('dob') and user.get('gender') and latest_weight is not None:
+                age = user['age']
+                height_cm = user['height_cm']
+            
+                bmr = 0
+                if user['gender'] == 'Male':
+                    bmr = 88.362 + (13.397 * latest_weight) + (4.799 * height_cm) - (5.677 * age)
+                elif user['gender'] == 'Female':
+                    bmr = 447.593 + (9.247 * latest_weight) + (3.098 * height_cm) - (4.330 * age)
+                else: # Use the Mifflin-St Jeor equation as a neutral alternative
+                    bmr = (10 * latest_weight) + (6.25 * height_cm) - (5 * age) + 5
+
+                tdee = bmr * 1.2 # Sedentary assumption
+                target_calories = tdee - 500 # For ~0.5kg/week loss
+
+                st.info(f"To reach your goal of **{goal_weight} kg**, a good starting point is to aim for around **{int(target_calories)} calories** per day. This creates a healthy deficit.")
+                st.write("#### Suggested Basic Exercises:")
+                st.markdown("""
+                - **Cardio:** 30 minutes of brisk walking, jogging, or cycling, 3-5 times a week.
+                - **Strength:** Bodyweight exercises like squats, push-ups, and planks, 2-3 times a week.
+                - **Flexibility:** Basic yoga or stretching daily to improve mobility.
+            
+                *Disclaimer: This is a basic suggestion. Please consult a healthcare professional before starting any new diet or exercise regimen.*
+                """)
+            elif submitted:
+                st.error("Please ensure your profile (height, DoB, Gender) and weight records are up to date.")
+
+@st.fragment
+def render_add_tab(user):
+    """Renders the form for adding a new vitals record."""
+    st.subheader("Add a New Health Record")
+    with st.form("vitals_form"):
+        record_date = st.date_input("Date of Record", datetime.now())
+        weight = st.number_input("Weight (kg)", min_value=0.0, format="%.1f", help="Leave as 0 if not recording")
+        bp_s = st.number_input("Blood Pressure - Systolic (e.g., 120)", min_value=0, help="Leave as 0 if not recording")
+        bp_d = st.number_input("Blood Pressure - Diastolic (e.g., 80)", min_value=0, help="Leave as 0 if not recording")
+        hr = st.number_input("Heart Rate (BPM)", min_value=0, help="Leave as 0 if not recording")
+        sugar = st.number_input("Blood Sugar (mg/dL)", min_value=0.0, format="%.1f", help="Leave as 0 if not recording")
+    
+        if st.form_submit_button("Save Record"):
+            readings = (weight if weight > 0 else None,
+                        bp_s if bp_s > 0 else None,
+                        bp_d if bp_d > 0 else None,
+                        hr if hr > 0 else None,
+                        sugar if sugar > 0 else None)
+            db_execute(SQL_INSERT_VITALS, (user['unique_id'], record_date.strftime('%Y-%m-%d %H:%M:%S'), *readings))
+            get_patient_vitals.clear(user['unique_id'])
+            get_latest_weight.clear(user['unique_id'])
+            old_version, new_version = bump_vitals_version(user['unique_id'])
+            # If no other session saved in between, append to this session's copy instead of re-reading the whole history
+            if st.session_state.get('vitals_version') == old_version:
+                vitals_df = st.session_state.vitals_df
+                new_row = pd.DataFrame([(pd.Timestamp(record_date), *readings)], columns=vitals_df.columns).astype({col: float for col in vitals_df.columns[1:]})
+                if vitals_df.empty:
+                    st.session_state.vitals_df = new_row
+                else:
+                    st.session_state.vitals_df = pd.concat([vitals_df, new_row], ignore_index=True).sort_values('Date', kind='stable', ignore_index=True)
+                st.session_state.vitals_version = new_version
+            else:
+                # Another session saved since this copy was loaded; drop it so the rerun reloads every record
+                st.session_state.pop('vitals_df', None)
+                st.session_state.pop('vitals_version', None)
+            st.success("New record added!")
+            if 'show_fitness_form' in st.session_state:
+                del st.session_state['show_fitness_form']
+            st.rerun()
 
 def patient_dashboard():
     """The main dashboard view for a logged-in patient."""
@@ -131,24 +410,20 @@ def patient_dashboard():
         with st.form("profile_form"):
             st.subheader("Update Your Info")
             height = st.number_input("Height (cm)", value=float(user.get('height_cm') or 0), format="%.1f")
-            dob = st.date_input("Date of Birth", value=datetime.strptime(user.get('dob') or '2000-01-01', '%Y-%m-%d'))
-            gender_options = ["Male", "Female", "Other", "Prefer not to say"]
-            gender_index = gender_options.index(user['gender']) if user.get('gender') and user.get('gender') in gender_options else 0
-            gender = st.selectbox("Gender", gender_options, index=gender_index)
-            diet_options = ["Vegetarian", "Non-Vegetarian", "Ovo-Vegetarian", "Jain"]
-            diet_index = diet_options.index(user['diet_pref']) if user.get('diet_pref') and user.get('diet_pref') in diet_options else 0
-            diet = st.selectbox("Dietary Preference", diet_options, index=diet_index)
+            dob = st.date_input("Date of Birth", value=date.fromisoformat(user.get('dob') or '2000-01-01'))
+            gender = st.selectbox("Gender", GENDER_OPTIONS, index=GENDER_IDX.get(user.get('gender'), 0))
+            diet = st.selectbox("Dietary Preference", DIET_OPTIONS, index=DIET_IDX.get(user.get('diet_pref'), 0))
             location = st.text_input("Location", value=user.get('location', ''))
 
             if st.form_submit_button("Save Profile"):
-                db_execute("UPDATE patients SET height_cm=?, dob=?, gender=?, diet_pref=?, location=? WHERE unique_id=?", 
-                           (height, dob.strftime('%Y-%m-%d'), gender, diet, location, user['unique_id']))
+                db_execute(SQL_UPDATE_PROFILE, (height, dob.strftime('%Y-%m-%d'), gender, diet, location, user['unique_id']))
                 # Update session state
                 st.session_state.user_info['height_cm'] = height
                 st.session_state.user_info['dob'] = dob.strftime('%Y-%m-%d')
                 st.session_state.user_info['gender'] = gender
                 st.session_state.user_info['diet_pref'] = diet
                 st.session_state.user_info['location'] = location
+                add_derived_profile_fields(st.session_state.user_info)
                 st.success("Profile Updated!")
                 st.rerun()
         
@@ -158,124 +433,27 @@ def patient_dashboard():
             st.rerun()
 
     # --- MAIN DASHBOARD TABS ---
-    vitals_df = get_patient_vitals(user['unique_id'])
+    # The session keeps its own vitals copy for the charts and reloads it once any session saves vitals for this patient
+    vitals_version = get_vitals_versions().get(user['unique_id'], 0)
+    if 'vitals_df' not in st.session_state or st.session_state.get('vitals_version') != vitals_version:
+        st.session_state.vitals_df = get_patient_vitals(user['unique_id'])
+        st.session_state.vitals_version = vitals_version
     prescriptions_df = get_patient_prescriptions(user['unique_id'])
     
     tab1, tab2, tab3, tab4 = st.tabs(["📊 Health Vitals", "💊 My Prescriptions", "🏋️ Fitness Hub", "➕ Add New Data"])
 
     with tab1:
-        st.subheader("Your Health Journey Over Time")
-        if vitals_df.empty:
-            st.info("No vitals data found. Add some data to see your charts!")
-        else:
-            # Weight Chart
-            if 'Weight (kg)' in vitals_df.columns and vitals_df['Weight (kg)'].notna().any():
-                fig_weight = px.line(vitals_df, x='Date', y='Weight (kg)', title='Weight Journey', markers=True)
-                st.plotly_chart(fig_weight, use_container_width=True)
-            
-            # BP Chart
-            if 'BP Systolic' in vitals_df.columns and vitals_df['BP Systolic'].notna().any():
-                fig_bp = px.line(vitals_df, x='Date', y=['BP Systolic', 'BP Diastolic'], title='Blood Pressure Trends', markers=True)
-                st.plotly_chart(fig_bp, use_container_width=True)
-            
-            # Heart Rate Chart
-            if 'Heart Rate (BPM)' in vitals_df.columns and vitals_df['Heart Rate (BPM)'].notna().any():
-                fig_hr = px.line(vitals_df, x='Date', y='Heart Rate (BPM)', title='Heart Rate Trends', markers=True)
-                st.plotly_chart(fig_hr, use_container_width=True)
-
-            # Sugar Chart
-            if 'Sugar Level' in vitals_df.columns and vitals_df['Sugar Level'].notna().any():
-                fig_sugar = px.line(vitals_df, x='Date', y='Sugar Level', title='Blood Sugar Trends', markers=True)
-                st.plotly_chart(fig_sugar, use_container_width=True)
+        render_vitals_tab(st.session_state.vitals_df)
 
     with tab2:
-        st.subheader("Your Prescription History")
-        if prescriptions_df.empty:
-            st.info("No prescriptions recorded.")
-        else:
-            # Group by visit to show a clean record
-            for visit_date, group in prescriptions_df.groupby('Visit Date'):
-                with st.expander(f"**Visit on {visit_date.split(' ')[0]}** with {group['Doctor'].iloc[0]}"):
-                    st.write(f"**Diagnosis:** {group['Summary'].iloc[0] or 'N/A'}")
-                    st.dataframe(group[['Medicine', 'Frequency', 'Timing']].reset_index(drop=True), use_container_width=True)
+        render_rx_tab(prescriptions_df)
 
     with tab3:
-        st.subheader("Your Fitness & Wellness Hub")
-        if user.get('height_cm') and user.get('height_cm') > 0 and not vitals_df.empty and vitals_df['Weight (kg)'].notna().any():
-            latest_weight = vitals_df.dropna(subset=['Weight (kg)'])['Weight (kg)'].iloc[-1]
-            height_m = user['height_cm'] / 100
-            bmi = latest_weight / (height_m ** 2)
-            
-            bmi_category = "Unknown"
-            if bmi < 18.5: bmi_category = "Underweight"
-            elif 18.5 <= bmi < 24.9: bmi_category = "Healthy Weight"
-            elif 25 <= bmi < 29.9: bmi_category = "Overweight"
-            else: bmi_category = "Obesity"
-
-            st.metric(label="Your Current BMI", value=f"{bmi:.2f}", help=f"Your current BMI category is {bmi_category}. Formula: $BMI = \\frac{{\\text{{weight (kg)}}}}{{\\text{{height (m)}}^2}}$")
-        else:
-            st.warning("Please add your height in the profile and at least one weight entry to calculate BMI.")
-        
-        st.divider()
-        # *** UPDATED BUTTON TEXT ***
-        if st.button("Create My Fitness Plan"):
-            st.session_state.show_fitness_form = True
-
-        if st.session_state.get("show_fitness_form"):
-            with st.form("fitness_form"):
-                goal_weight = st.number_input("What is your goal weight (kg)?", min_value=30.0, step=1.0)
-                
-                submitted = st.form_submit_button("Calculate My Plan")
-                if submitted and goal_weight > 0 and user.get('dob') and user.get('gender') and not vitals_df.empty:
-                    age = datetime.now().year - datetime.strptime(user['dob'], '%Y-%m-%d').year
-                    latest_weight = vitals_df.dropna(subset=['Weight (kg)'])['Weight (kg)'].iloc[-1]
-                    height_cm = user['height_cm']
-                    
-                    bmr = 0
-                    if user['gender'] == 'Male':
-                        bmr = 88.362 + (13.397 * latest_weight) + (4.799 * height_cm) - (5.677 * age)
-                    elif user['gender'] == 'Female':
-                        bmr = 447.593 + (9.247 * latest_weight) + (3.098 * height_cm) - (4.330 * age)
-                    else: # Use the Mifflin-St Jeor equation as a neutral alternative
-                        bmr = (10 * latest_weight) + (6.25 * height_cm) - (5 * age) + 5
-
-                    tdee = bmr * 1.2 # Sedentary assumption
-                    target_calories = tdee - 500 # For ~0.5kg/week loss
-
-                    st.info(f"To reach your goal of **{goal_weight} kg**, a good starting point is to aim for around **{int(target_calories)} calories** per day. This creates a healthy deficit.")
-                    st.write("#### Suggested Basic Exercises:")
-                    st.markdown("""
-                    - **Cardio:** 30 minutes of brisk walking, jogging, or cycling, 3-5 times a week.
-                    - **Strength:** Bodyweight exercises like squats, push-ups, and planks, 2-3 times a week.
-                    - **Flexibility:** Basic yoga or stretching daily to improve mobility.
-                    
-                    *Disclaimer: This is a basic suggestion. Please consult a healthcare professional before starting any new diet or exercise regimen.*
-                    """)
-                elif submitted:
-                    st.error("Please ensure your profile (height, DoB, Gender) and weight records are up to date.")
+        render_fitness_tab(user)
 
     with tab4:
-        st.subheader("Add a New Health Record")
-        with st.form("vitals_form"):
-            record_date = st.date_input("Date of Record", datetime.now())
-            weight = st.number_input("Weight (kg)", min_value=0.0, format="%.1f", help="Leave as 0 if not recording")
-            bp_s = st.number_input("Blood Pressure - Systolic (e.g., 120)", min_value=0, help="Leave as 0 if not recording")
-            bp_d = st.number_input("Blood Pressure - Diastolic (e.g., 80)", min_value=0, help="Leave as 0 if not recording")
-            hr = st.number_input("Heart Rate (BPM)", min_value=0, help="Leave as 0 if not recording")
-            sugar = st.number_input("Blood Sugar (mg/dL)", min_value=0.0, format="%.1f", help="Leave as 0 if not recording")
-            
-            if st.form_submit_button("Save Record"):
-                db_execute("INSERT INTO vitals (patient_id, record_date, weight_kg, bp_systolic, bp_diastolic, heart_rate, sugar_level) VALUES (?,?,?,?,?,?,?)",
-                           (user['unique_id'], record_date.strftime('%Y-%m-%d %H:%M:%S'), 
-                            weight if weight > 0 else None,
-                            bp_s if bp_s > 0 else None,
-                            bp_d if bp_d > 0 else None,
-                            hr if hr > 0 else None,
-                            sugar if sugar > 0 else None))
-                st.success("New record added!")
-                if 'show_fitness_form' in st.session_state:
-                    del st.session_state['show_fitness_form']
-                st.rerun()
+        render_add_tab(user)
+
 
 def patient_journey():
     """Handles the entire flow for a patient, from login to dashboard."""
@@ -295,8 +473,7 @@ def patient_journey():
                 else:
                     try:
                         unique_id = str(uuid.uuid4())[:8].upper()
-                        db_execute("INSERT INTO patients (unique_id, first_name, last_name, email, phone) VALUES (?,?,?,?,?)",
-                                   (unique_id, fname, lname, email, phone))
+                        db_execute(SQL_INSERT_PATIENT, (unique_id, fname, lname, email, phone))
                         st.success(f"Registration Successful! Your Unique ID is: **{unique_id}**")
                         st.info("Please save this ID securely for future logins.")
                     except sqlite3.IntegrityError:
@@ -309,17 +486,14 @@ def patient_journey():
             unique_id = st.text_input("Unique ID*")
             
             if st.form_submit_button("Login"):
-                user_data = db_query("SELECT * FROM patients WHERE lower(first_name)=? AND upper(unique_id)=?", (fname.lower().strip(), unique_id.upper().strip()))
+                user_data = db_query(SQL_LOGIN_PATIENT, (fname.strip(), unique_id.strip()))
                 if user_data:
-                    user_details = user_data[0]
                     st.session_state.logged_in = True
                     st.session_state.role = 'Patient'
-                    st.session_state.user_info = {
-                        'unique_id': user_details[0], 'first_name': user_details[1], 'last_name': user_details[2],
-                        'email': user_details[3], 'phone': user_details[4], 'dob': user_details[5],
-                        'location': user_details[6], 'height_cm': user_details[7], 'diet_pref': user_details[8],
-                        'gender': user_details[9]
-                    }
+                    st.session_state.user_info = add_derived_profile_fields(dict(user_data[0]))
+                    # Never carry a vitals copy over from a previous login
+                    st.session_state.pop('vitals_df', None)
+                    st.session_state.pop('vitals_version', None)
                     st.rerun()
                 else:
                     st.error("Invalid credentials. Please check your First Name and Unique ID.")
@@ -366,8 +540,8 @@ def doctor_portal():
         for i, med in enumerate(st.session_state.medicines):
             cols = st.columns([4, 3, 3])
             med['name'] = cols[0].text_input("Medicine Name", value=med.get('name', ''), key=f"med_name_{i}", label_visibility="collapsed", placeholder=f"Medicine Name {i+1}")
-            med['freq'] = cols[1].selectbox("Frequency", ["Once a day", "Twice a day", "Thrice a day"], index=["Once a day", "Twice a day", "Thrice a day"].index(med.get('freq', 'Once a day')), key=f"med_freq_{i}", label_visibility="collapsed")
-            med['timing'] = cols[2].selectbox("Timing", ["Empty Stomach", "After Breakfast", "After Lunch", "After Dinner", "Before Sleep"], index=["Empty Stomach", "After Breakfast", "After Lunch", "After Dinner", "Before Sleep"].index(med.get('timing', 'After Breakfast')), key=f"med_time_{i}", label_visibility="collapsed")
+            med['freq'] = cols[1].selectbox("Frequency", FREQUENCY_OPTIONS, index=FREQUENCY_IDX.get(med.get('freq', 'Once a day'), 0), key=f"med_freq_{i}", label_visibility="collapsed")
+            med['timing'] = cols[2].selectbox("Timing", TIMING_OPTIONS, index=TIMING_IDX.get(med.get('timing', 'After Breakfast'), 0), key=f"med_time_{i}", label_visibility="collapsed")
         
         st.markdown("---")
         save_rx_button = st.form_submit_button("Save Full Prescription", use_container_width=True)
@@ -376,26 +550,26 @@ def doctor_portal():
             if not patient_id:
                 st.error("Patient Unique ID is required.")
             else:
-                patient_exists = db_query("SELECT 1 FROM patients WHERE upper(unique_id)=?", (patient_id.upper().strip(),))
-                if not patient_exists:
-                    st.error(f"No patient found with ID: {patient_id}")
+                medicines = [med for med in st.session_state.medicines if med['name'].strip()]
+                if not medicines:
+                    st.warning("No medicines were entered. Prescription not saved.")
                 else:
-                    prescription_saved = False
-                    for med in st.session_state.medicines:
-                        if med['name'].strip():
-                            db_execute("INSERT INTO prescriptions (patient_id, doctor_name, visit_date, summary, medicine, frequency, timing) VALUES (?,?,?,?,?,?,?)",
-                                       (patient_id.upper().strip(), full_name, visit_date.strftime('%Y-%m-%d'), summary, med['name'], med['freq'], med['timing']))
-                            prescription_saved = True
-                    
-                    if prescription_saved:
+                    # One statement inserts every medicine, but only if the patient exists
+                    params = {'pid': patient_id.upper().strip(), 'doc': full_name, 'date': visit_date.strftime('%Y-%m-%d'), 'sum': summary}
+                    for i, med in enumerate(medicines):
+                        params.update({f'name{i}': med['name'], f'freq{i}': med['freq'], f'timing{i}': med['timing']})
+                    values = ", ".join(f"(:name{i}, :freq{i}, :timing{i})" for i in range(len(medicines)))
+                    inserted = db_execute(SQL_INSERT_RX.format(values=values), params)
+                    if not inserted:
+                        st.error(f"No patient found with ID: {patient_id}")
+                    else:
+                        get_patient_prescriptions.clear(params['pid'])
                         st.success("Prescription saved successfully!")
                         # Clear form state after successful submission
                         del st.session_state.medicines
                         if "rx_patient_id" in st.session_state: del st.session_state.rx_patient_id
                         if "rx_summary" in st.session_state: del st.session_state.rx_summary
                         st.rerun()
-                    else:
-                        st.warning("No medicines were entered. Prescription not saved.")
 
 def doctor_journey():
     """Handles the entire flow for a doctor."""
@@ -415,8 +589,7 @@ def doctor_journey():
                     st.error("Please fill all fields.")
                 else:
                     try:
-                        db_execute("INSERT INTO doctors (first_name, last_name, email, phone, speciality) VALUES (?,?,?,?,?)",
-                                   (fname, lname, email, phone, speciality))
+                        db_execute(SQL_INSERT_DOCTOR, (fname, lname, email, phone, speciality))
                         st.success("Doctor registered successfully! Please login.")
                     except sqlite3.IntegrityError:
                         st.error("A doctor with this email or phone already exists.")
@@ -429,15 +602,11 @@ def doctor_journey():
             phone = st.text_input("Phone Number*")
             
             if st.form_submit_button("Login"):
-                user_data = db_query("SELECT * FROM doctors WHERE lower(first_name)=? AND lower(last_name)=? AND phone=?", (fname.lower().strip(), lname.lower().strip(), phone.strip()))
+                user_data = db_query(SQL_LOGIN_DOCTOR, (fname.strip(), lname.strip(), phone.strip()))
                 if user_data:
-                    user_details = user_data[0]
                     st.session_state.logged_in = True
                     st.session_state.role = 'Doctor'
-                    st.session_state.user_info = {
-                        'id': user_details[0], 'first_name': user_details[1], 'last_name': user_details[2],
-                        'email': user_details[3], 'phone': user_details[4], 'speciality': user_details[5]
-                    }
+                    st.session_state.user_info = dict(user_data[0])
                     st.rerun()
                 else:
                     st.error("Invalid credentials.")